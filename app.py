@@ -1,23 +1,50 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from quart import Quart, Response, render_template, request, jsonify
+from quart.json.provider import DefaultJSONProvider
 import google.generativeai as genai
-import json
+from google.api_core.exceptions import ResourceExhausted
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import asyncio
+import diskcache
+import functools
+import hashlib
+import ijson
+import io
+import logging
+import multiprocessing
+import orjson
 import os
+import random
 import re 
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import mm
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+import string
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
 from datetime import datetime
-import tempfile
+from urllib.parse import quote
 from dotenv import load_dotenv
+from pdf_builder import generate_pdf_bytes
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
-app = Flask(__name__)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger('quiz')
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify やリクエストのJSONパースを orjson で高速化する"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
 
 # Gemini API設定
 api_key = os.environ.get('GEMINI_API_KEY')
@@ -29,91 +56,591 @@ model = genai.GenerativeModel('gemini-2.5-flash')
 # 2.5 flashの場合、(RPM, TPM, RPD)=(10, 250000, 250)
 # 2.5 proの場合、(RPM, TPM, RPD)=(5, 250000, 100)
 
-#フォントの設定
-try:
-    pdfmetrics.registerFont(TTFont('NotoSansCJK', 'NotoSansJP-Regular.ttf'))
-    pdfmetrics.registerFont(TTFont('DejaVu', 'DejaVuSans.ttf'))
-    FONT_NAME = 'NotoSansCJK'
+# Gemini APIへの同時リクエスト数の上限（クォータを超えるバーストを防ぐ）
+gemini_semaphore = asyncio.Semaphore(int(os.environ.get('GEMINI_MAX_CONCURRENCY', '10')))
+
+# プロンプトの内容に影響するオプション（同じ値のリクエストのみまとめて生成する）
+PROMPT_OPTION_KEYS = ('calculation_only', 'word_problems', 'vocabulary_list')
+
+# JSON文字列中の正しいエスケープ、または単独のバックスラッシュにマッチする
+JSON_ESCAPE_RE = re.compile(r'\\(["\\/bfnrt]|u[0-9a-fA-F]{4})|\\')
+
+# 問題プールを作るために1回の生成で最低限作成する問題数
+POOL_MIN_SIZE = 10
+
+# 1回のAI呼び出しで生成する問題数の上限（1リクエストの問題数の上限も兼ねる）
+MAX_PROBLEMS_PER_CALL = 50
+
+# 生成結果のディスクキャッシュ保存先（ワーカー間で共有する）
+CACHE_DIR = os.environ.get('QUIZ_CACHE_DIR', '/tmp/quiz_cache')
+
+# ディスクキャッシュの有効期限（秒）。期限切れ後は問題を新しく生成し直す
+CACHE_TTL = int(os.environ.get('QUIZ_CACHE_TTL', str(24 * 60 * 60)))
+
+# /api/get_units のレスポンスに付与するキャッシュ指定
+UNITS_CACHE_CONTROL = 'public, max-age=86400, immutable'
+
+# Hypercornワーカー1つあたりのPDF生成プロセス数（全体ではワーカー数 × この値になる）
+PDF_POOL_WORKERS = int(os.environ.get('PDF_POOL_WORKERS', '1'))
+
+# PDFをクライアントへ送信する際のチャンクサイズ
+PDF_CHUNK_SIZE = 64 * 1024
+
+def renumber_problems(problems):
+    """切り分け・抽選した問題の番号を1から振り直す"""
+    return [dict(problem, id=i + 1) for i, problem in enumerate(problems)]
+
+class BatchProcessor:
+    """
+    短時間に届いた同じ条件の問題生成リクエストをまとめ、1回のAI呼び出しで処理する。
+    生成された問題は各リクエストの問題数に応じて切り分けて返す。
+    """
+    def __init__(self, handler, flush_interval=0.2, max_batch=8, max_total=MAX_PROBLEMS_PER_CALL):
+        self.handler = handler
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_total = max_total
+        self.queue = deque()
+        self._wakeup = None
+        self._task = None
+        self._running = set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, key, count):
+        """リクエストをキューに追加し、切り分けられた結果を待つ"""
+        if self._task is None:
+            raise RuntimeError("BatchProcessor が起動していません。start() を呼び出してください。")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((key, count, future))
+        if len(self.queue) >= self.max_batch:
+            self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            self._flush()
+
+    def _flush(self):
+        groups = {}
+        while self.queue:
+            key, count, future = self.queue.popleft()
+            try:
+                batches = groups.setdefault(key, [[]])
+            except Exception as e:
+                # キーが不正なリクエストだけを失敗させ、バックグラウンド処理は継続する
+                if not future.done():
+                    future.set_exception(e)
+                continue
+
+            # 1回の呼び出しで生成する問題数が上限を超える場合は別の呼び出しに分ける
+            pending = batches[-1]
+            if pending and sum(c for c, _ in pending) + count > self.max_total:
+                pending = []
+                batches.append(pending)
+            pending.append((count, future))
+
+        for key, batches in groups.items():
+            for pending in batches:
+                task = asyncio.create_task(self._process(key, pending))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _process(self, key, pending):
+        total = sum(count for count, _ in pending)
+        try:
+            problems = await self.handler(key, total)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for count, future in pending:
+            chunk = problems[offset:offset + count]
+            offset += count
+            if future.done():
+                continue
+            try:
+                if not chunk:
+                    raise ValueError("AIが生成した問題数が不足しています")
+                future.set_result({"problems": renumber_problems(chunk)})
+            except Exception as e:
+                future.set_exception(e)
+
+class ResponseCache:
+    """
+    プロンプトのSHA-256をキーに、生成済みの問題データを保存するキャッシュ。
+    プロセス内のLRUと、ワーカー間で共有するディスクキャッシュの2段構成。
+    """
+    def __init__(self, directory, maxsize=512, expire=None):
+        self.maxsize = maxsize
+        self.expire = expire
+        self.memory = OrderedDict()
+        self.disk = diskcache.Cache(directory)
+
+    @staticmethod
+    def _key(prompt):
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    async def get(self, prompt):
+        key = self._key(prompt)
+        if key in self.memory:
+            expires_at, problems_data = self.memory[key]
+            if expires_at is None or expires_at > time.monotonic():
+                self.memory.move_to_end(key)
+                return problems_data
+            del self.memory[key]
+
+        # diskcache は同期的にSQLiteを読むため、イベントループを止めないよう別スレッドで実行する
+        cached = await asyncio.to_thread(self.disk.get, key)
+        if cached is None:
+            return None
+        problems_data = orjson.loads(cached)
+        self._remember(key, problems_data)
+        return problems_data
+
+    async def set(self, prompt, problems_data):
+        key = self._key(prompt)
+        self._remember(key, problems_data)
+        await asyncio.to_thread(self.disk.set, key, orjson.dumps(problems_data), expire=self.expire)
+
+    def _remember(self, key, problems_data):
+        expires_at = time.monotonic() + self.expire if self.expire else None
+        self.memory[key] = (expires_at, problems_data)
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+# 科目・学年ごとの単元一覧（読み取り専用。ワーカー間でそのまま共有できる）
+SUBJECT_UNITS = MappingProxyType({
+    'math': MappingProxyType({
+        '中学1年': ('正負の数', '文字と式', '一次方程式', '比例・反比例', '平面図形', '空間図形', 'データの活用'),
+        '中学2年': ('式の計算', '連立方程式', '一次関数', '図形の性質', '確率'),
+        '中学3年': ('展開と因数分解', '平方根', '二次方程式', '二次関数', '相似', '円', '三平方の定理', '標本調査'),
+        '数学ⅠA': ('数と式', '集合と論証', '二次関数', '図形と計量', 'データの分析', '場合の数と確率', '整数の性質', '平面図形と空間図形'),
+        '数学ⅡB': ('式と証明', '複素数と方程式', '図形と方程式', '三角関数', '指数・対数関数', '微分法', '積分法', '数列', '確率分布'),
+        '数学ⅢC': ('分数関数と無理関数', '極限', '微分法', '微分法の応用', '積分法', '積分法の応用', 'ベクトル', '複素数平面', '二次曲線')
+    }),
+    'english': MappingProxyType({
+        '中学1年': ('be動詞', '一般動詞', '疑問文・否定文', '代名詞', '複数形'),
+        '中学2年': ('過去形', '未来形', '助動詞', '比較級', '最上級', '不定詞', '動名詞'),
+        '中学3年': ('現在完了形', '受動態', '関係代名詞', '間接疑問文'),
+        '高校英文法': (
+            '時制', 
+            '助動詞', 
+            '受動態', 
+            '不定詞', 
+            '動名詞', 
+            '分詞', 
+            '関係詞', 
+            '比較', 
+            '仮定法', 
+            '接続詞',
+            '強調・倒置・挿入・省略', 
+            '一致・話法', 
+            '否定構文',
+            '名詞構文' ,
+            '無生物主語構文',
+            '前置詞',
+            '語法',
+            '文法総合'
+            ),
+        '高校英語長文': ('文化', '日常生活', '自然', '科学・技術', '社会', '産業', '歴史', '環境', '教育', '健康', '国際問題')
+    })
+})
+EMPTY_UNITS = MappingProxyType({})
+
+# Gemini に渡すレスポンスのJSONスキーマ（出力形式はプロンプトではなくスキーマで指定する）
+QUESTION_ITEM_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "id": {"type": "INTEGER"},
+        "question": {"type": "STRING"},
+        "choices": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "answer": {"type": "STRING"},
+        "explanation": {"type": "STRING"}
+    },
+    "required": ["id", "question", "answer", "explanation"],
+    # 指定しないとアルファベット順に生成されるため、問題文を解答より先に書かせる
+    "property_ordering": ["id", "question", "choices", "answer", "explanation"]
+}
+
+PROBLEM_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "problems": {"type": "ARRAY", "items": QUESTION_ITEM_SCHEMA}
+    },
+    "required": ["problems"]
+}
+
+READING_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "reading_passage": {"type": "STRING"},
+        "questions": {"type": "ARRAY", "items": QUESTION_ITEM_SCHEMA}
+    },
+    "required": ["reading_passage", "questions"],
+    # 本文を設問より先に生成させる（ストリーミング時も本文から届く）
+    "property_ordering": ["reading_passage", "questions"]
+}
+
+# property_ordering は google-ai-generativelanguage 0.6.18 以降でのみ指定できる
+if 'property_ordering' not in genai.protos.Schema.meta.fields:
+    logger.warning("google-ai-generativelanguage が古いため、スキーマのプロパティ順序の指定を無効にします。")
+    del QUESTION_ITEM_SCHEMA['property_ordering']
+    del READING_SCHEMA['property_ordering']
+
+# ---- プロンプトのひな形（読み込み時に一度だけ作成し、呼び出し時に値を埋め込む） ----
+# 高校英語長文問題生成用プロンプト
+READING_PROMPT_TEMPLATE = string.Template("""
+
+あなたは予備校の英語の講師です。以下の指示に厳密に従って、高品質な英語長文問題を作成してください。
+
+【最重要指示】
+これから生成する英語長文は、必ず、厳密に ${paragraph_count} 個の段落で構成してください。これより多くても少なくても絶対に不可です。
+
+【タスク】
+1. トピックが「${unit}」に関連する、高校生レベルの英語長文を1つ、上記の段落数厳守で生成します。
+2. ${task_instruction}
+
+難易度は「${difficulty}」でお願いします。
+
+【詳細な要件】
+- 長文は${difficulty}, ${grade}のレベルに適した語彙・文法を使用すること。
+- ${difficulty}が「基礎」の場合、英検3級から英検準2級レベルの語彙・文法を使用し、英語コミュニケーションの教科書レベルの問題を作成すること。
+- ${difficulty}が「標準」の場合、英検準2級から英検2級レベルの語彙・文法を使用し、英語コミュニケーションの教科書レベルの問題を作成すること。
+- ${difficulty}が「応用」の場合、英検準2級から英検2級レベルの語彙・文法を使用し、大学入試レベルの問題を作成すること。
+- ${difficulty}が「発展」の場合、英検2級から英検準1級以上のレベルの語彙・文法を使用し、大学入試レベルの問題を作成すること。
+- ${unit}に関する文章をそのまま書くのではなく、関連する内容を含む長文を必ず生成すること。
+- 問題はその段落について問う問題は避け、長文全体の内容に関する問題を作成すること。
+- 記述問題の場合、必ず12語以内で答えられる問題にすること。
+- 1個の問題の中に2つ以上の要素を含めないこと。
+- 段落ごとの文章量は、平均して100-120語程度とすること。
+- 全て同じようなジャンルの問題にはしないこと。多様なジャンルの問題にすること。
+- `questions`配列には、必ず${count}個の問題オブジェクトを含めること。
+- 設問は長文の内容に関するものにすること。
+- "choices"は選択問題の場合のみ含めること。
+- 解説は「である調」で、簡潔に記述すること。
+- 数式はLaTeX記法 (例: \\( ... \\) や $$...$$) を一切使わず、プレーンテキストと一般的な記号(+, -, *, /, ^)のみで表現すること。
+""")
+
+# 数学問題生成用プロンプト
+MATH_PROMPT_TEMPLATE = string.Template("""
+    ${instruction}
+
+要件：
+- 問題は${grade}のレベルに適した、難易度「${difficulty}」で作成すること
+- ${difficulty}が基礎の場合、教科書の例題レベルの問題を作成すること
+- ${difficulty}が標準の場合、教科書の練習問題レベルの問題を作成すること
+- ${difficulty}が応用の場合、教科書の発展問題レベルの問題を作成すること
+- ${difficulty}が発展かつ${grade}が中学1年生、中学2年生、中学3年生の場合、高校入試レベルの問題を作成すること
+- ${difficulty}が発展かつ${grade}が数学ⅠA、数学ⅡB、数学ⅢCの場合、大学入試レベルの問題を作成すること
+- 解説は生徒が理解しやすいよう詳しく書く
+- 計算過程も含める
+- "choices"は${problem_type}が「選択問題」の場合のみ含めること。それ以外の場合はnullではなくキー自体を省略すること。
+- 【最重要ルール】JSONの仕様を厳格に遵守すること。JSON文字列内でバックスラッシュ(`\\`)を1つだけ使用することは絶対に禁止。
+- 解答解説は「ですます調」ではなく、簡潔な「である調」で記述すること。
+- 解説は、要点を押さえて、必ず簡潔に記述すること。計算過程は主要なステップのみを示すこと。
+- pi, theta, sigma, alpha, betaなどの英語はそれぞれの記号（π, θ, Σ, α, β）を使用すること。
+- _barはバー（上線）を意味するので、例えば「x_bar」は「x_」と表記すること。
+- sqrtは平方根を意味するので、例えば「sqrt(2)」は「√2」と表記すること。
+- ネイピア数は「e」と表記すること。expの使用は禁止。
+- ${unit}が積分法の場合、不定積分と定積分の計算問題のみを出題すること。面積や体積の問題は出題禁止。
+- 三角関数の積分問題を出題する場合は、逆関数や双曲線関数を扱う問題は出題禁止。
+- 数学ⅡBと数学ⅢCの積分法の定積分の表記方法は、必ず「∫[a→b]f(x) dx」の形式で記述すること。
+- 自然対数は必ず「log(x)」と表記すること。
+- 【最重要ルール】下付き文字や上付き文字は、Unicode文字（例: ₂, ²）を使わず、必ずHTMLタグ（例: log<sub>2</sub>(x), x<sup>2</sup>）を使って表現すること。
+- 掛け算を表す記号「⋅」は、必ず <font name="DejaVu">⋅</font> のようにフォントタグで囲んでください。
+- 数式はLaTeX記法 (例: \\( ... \\) や $$...$$) を一切使わず、プレーンテキストと一般的な記号(+, -, *, /, ^)のみで表現すること。
+- 「*」、「\」は使わないこと
+""")
+
+# 英文法問題: 全ての形式で共通する基本的な要件
+ENGLISH_COMMON_REQUIREMENTS_TEMPLATE = string.Template("""
+- 難易度は「${difficulty}」とすること
+- ${difficulty}が「基礎」の場合、教科書の例題レベルの問題を作成すること
+- ${difficulty}が「標準」の場合、教科書の練習問題レベルの問題を作成すること
+- ${difficulty}が「応用」の場合、教科書の発展問題レベルの問題を作成すること
+- ${difficulty}が発展かつ${grade}が中学1年生、中学2年生、中学3年生の場合、高校入試レベルの問題を作成すること
+- ${difficulty}が発展かつ${grade}が高校英文法の場合、大学入試レベルの問題を作成すること
+- 解説では文法ポイントも詳しく説明
+- 実用的な例文を使用
+- "choices"は問題形式が「選択問題」の場合のみ含めること。それ以外の形式の場合はキー自体を省略すること。
+- JSON文字列内にバックスラッシュ(`\\`)を含める場合は、必ず二重バックスラッシュ(`\\\\`)としてエスケープすること。
+- 解答解説は「ですます調」ではなく、簡潔な「である調」で記述すること。
+- 数式はLaTeX記法 (例: \\( ... \\) や $$...$$) を一切使わず、プレーンテキストと一般的な記号(+, -, *, /, ^)のみで表現すること。
+- 「*」は使わないこと
+""")
+
+# 英文法問題: 「おまかせ (ミックス)」のタスク指示と追加要件
+ENGLISH_MIX_INSTRUCTION_TEMPLATE = string.Template("""${grade}の英語「${unit}」に関する問題を、以下の形式をバランス良く組み合わせて合計${count}問作成してください。
+- 空所補充問題
+- 語句整序問題（並び替え）
+- 間違い探し問題
+- 和文英訳問題""")
+
+ENGLISH_MIX_REQUIREMENTS = """
+- 【最重要】必ず「空所補充」「語句整序」「間違い探し」「和文英訳」など、異なる形式の問題を混ぜて出題すること。
+- 語句整序問題の場合、questionには並び替えるべき語句を()で示し、answerには正しい全文を記述すること。例: question: "次の語句を並び替えて文を完成させなさい。 (me / to / he / a letter / sent).", answer: "He sent me a letter."
+- 間違い探し問題の場合、questionには誤りを含む文を提示し、answerには修正後の正しい語句または文を記述すること。
+"""
 
-except Exception as e:
-    print(f"フォント読み込みエラー: {e}")
-    print("日本語フォントが読み込めないため、英語フォント(Helvetica)にフォールバックします。文字化けする可能性があります。")
-    FONT_NAME = 'Helvetica'
+# 英文法問題: 単一の形式が選択された場合の追加要件
+ENGLISH_SINGLE_REQUIREMENTS_TEMPLATE = string.Template("""
+- 【最重要】必ず全ての問題を「${problem_type}」の形式で作成すること。他の形式の問題は絶対に混ぜないこと。
+- 正解は文法的に一意に定まるものであり、他の選択肢は明確に不正解となるように作成すること。
+""")
+
+# 英文法問題生成用プロンプト
+ENGLISH_PROMPT_TEMPLATE = string.Template("""
+${task_instruction}
+
+要件：
+${requirements}
+""")
+
+class ProblemPool:
+    """
+    条件（科目・学年・単元・形式・難易度・オプション）ごとに生成済みの問題をまとめて保持し、
+    問題数がそれ以下のリクエストにはAIを呼ばずにその中から抽選して返す。
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.pools = OrderedDict()
+
+    def sample(self, key, count):
+        pool = self.pools.get(key)
+        if pool is None or len(pool) < count:
+            return None
+        self.pools.move_to_end(key)
+        return {"problems": renumber_problems(random.sample(pool, count))}
+
+    def add(self, key, problems):
+        # まとめて生成した大きなプールを、それより少ない問題で上書きしない
+        pool = self.pools.get(key)
+        if pool is not None and len(pool) > len(problems):
+            return
+        self.pools[key] = problems
+        self.pools.move_to_end(key)
+        if len(self.pools) > self.maxsize:
+            self.pools.popitem(last=False)
 
 class ProblemGenerator:
     def __init__(self):
-        self.subject_templates = {
-            'math': {
-                'units': {
-                    '中学1年': ['正負の数', '文字と式', '一次方程式', '比例・反比例', '平面図形', '空間図形', 'データの活用'],
-                    '中学2年': ['式の計算', '連立方程式', '一次関数', '図形の性質', '確率'],
-                    '中学3年': ['展開と因数分解', '平方根', '二次方程式', '二次関数', '相似', '円', '三平方の定理', '標本調査'],
-                    '数学ⅠA': ['数と式', '集合と論証', '二次関数', '図形と計量', 'データの分析', '場合の数と確率', '整数の性質', '平面図形と空間図形'],
-                    '数学ⅡB': ['式と証明', '複素数と方程式', '図形と方程式', '三角関数', '指数・対数関数', '微分法', '積分法', '数列', '確率分布'],
-                    '数学ⅢC': ['分数関数と無理関数', '極限', '微分法', '微分法の応用', '積分法', '積分法の応用', 'ベクトル', '複素数平面', '二次曲線']
-                }
-            },
-            'english': {
-                'units': {
-                    '中学1年': ['be動詞', '一般動詞', '疑問文・否定文', '代名詞', '複数形'],
-                    '中学2年': ['過去形', '未来形', '助動詞', '比較級', '最上級', '不定詞', '動名詞'],
-                    '中学3年': ['現在完了形', '受動態', '関係代名詞', '間接疑問文'],
-                    '高校英文法': [
-                        '時制', 
-                        '助動詞', 
-                        '受動態', 
-                        '不定詞', 
-                        '動名詞', 
-                        '分詞', 
-                        '関係詞', 
-                        '比較', 
-                        '仮定法', 
-                        '接続詞',
-                        '強調・倒置・挿入・省略', 
-                        '一致・話法', 
-                        '否定構文',
-                        '名詞構文' ,
-                        '無生物主語構文',
-                        '前置詞',
-                        '語法',
-                        '文法総合'
-                        ],
-                    '高校英語長文': ['文化', '日常生活', '自然', '科学・技術', '社会', '産業', '歴史', '環境', '教育', '健康', '国際問題']
-                }
-            }
-        }
+        self.batch_processor = BatchProcessor(self._generate_batch)
+        self.response_cache = ResponseCache(CACHE_DIR, expire=CACHE_TTL)
+        self.problem_pool = ProblemPool()
 
     def _fix_json_escapes(self, json_string: str) -> str:
         """
         AIが生成したJSON文字列内の、あらゆる不正なバックスラッシュを修正する。
+        正しいエスケープはそのまま残し、単独のバックスラッシュのみを1回の走査で二重化する。
         """
-        valid_escapes = {
-            '\\n': '__NEWLINE__',
-            '\\"': '__QUOTE__',
-            '\\\\': '__BACKSLASH__',
-            '\\/': '__SLASH__',
-            '\\b': '__BACKSPACE__',
-            '\\f': '__FORMFEED__',
-            '\\r': '__CARRIAGERETURN__',
-            '\\t': '__TAB__',
-        }
-        for original, placeholder in valid_escapes.items():
-            json_string = json_string.replace(original, placeholder)
-        
-        json_string = json_string.replace('\\', '\\\\')
-        
-        for original, placeholder in valid_escapes.items():
-            json_string = json_string.replace(placeholder, original)
-            
-        return json_string
+        return JSON_ESCAPE_RE.sub(
+            lambda m: m.group(0) if m.group(1) else '\\\\',
+            json_string
+        )
 
 
-    def generate_problems(self, subject, grade, unit, problem_type, count, difficulty, options=None):
+    async def generate_problems(self, subject, grade, unit, problem_type, count, difficulty, options=None):
         """AIを使って問題を生成"""
-        
+        options = options or {}
+        is_reading = grade == '高校英語長文'
+        batch_key = None if is_reading else self._batch_key(subject, grade, unit, problem_type, difficulty, options)
+        prompt = self._build_prompt(subject, grade, unit, problem_type, count, difficulty, options)
+
+        # nocache: キャッシュを一切使わない / fresh: 新しく生成し直してキャッシュを更新する
+        use_cache = not options.get('nocache')
+        if use_cache and not options.get('fresh'):
+            # 同じ条件で生成済みの問題が十分にあれば、その中から抽選して返す
+            if batch_key is not None:
+                sampled = self.problem_pool.sample(batch_key, count)
+                if sampled is not None:
+                    return sampled
+
+            cached = await self.response_cache.get(prompt)
+            if cached is not None:
+                return cached
+
+        try:
+            if is_reading:
+                # 長文は1つの本文に設問が紐づくため、まとめずに個別に生成する
+                problems_data = await self._request_problems(prompt, READING_SCHEMA)
+            else:
+                # キャッシュの利用有無が異なるリクエストは別々にまとめる
+                problems_data = await self.batch_processor.submit((batch_key, use_cache), count)
+        except Exception as e:
+            logger.exception("AI生成エラー (%s): %s", type(e).__name__, e)
+            return self._generate_fallback_problems(subject, grade, unit, count)
+
+        if use_cache:
+            await self.response_cache.set(prompt, problems_data)
+        return problems_data
+
+    async def stream_problems(self, subject, grade, unit, problem_type, count, difficulty, options=None):
+        """
+        問題を生成し、完成した要素から順に (イベント名, データ) を返す。
+        長文の場合は 'passage' で本文を、それ以外は 'problem' で1問ずつ返す。
+        """
+        options = options or {}
+        is_reading = grade == '高校英語長文'
+        batch_key = None if is_reading else self._batch_key(subject, grade, unit, problem_type, difficulty, options)
+        prompt = self._build_prompt(subject, grade, unit, problem_type, count, difficulty, options)
+
+        use_cache = not options.get('nocache')
+        if use_cache and not options.get('fresh'):
+            cached = None
+            if batch_key is not None:
+                cached = self.problem_pool.sample(batch_key, count)
+            if cached is None:
+                cached = await self.response_cache.get(prompt)
+            if cached is not None:
+                for event in self._iter_events(cached):
+                    yield event
+                return
+
+        problems_data = {'questions': []} if is_reading else {'problems': []}
+        problem_list = problems_data['questions' if is_reading else 'problems']
+        try:
+            async for event, payload in self._stream_content(prompt, is_reading):
+                if event == 'passage':
+                    problems_data['reading_passage'] = payload
+                else:
+                    problem_list.append(payload)
+                yield event, payload
+        except Exception as e:
+            logger.exception("AI生成エラー (%s): %s", type(e).__name__, e)
+            if problem_list:
+                raise
+            for event in self._iter_events(self._generate_fallback_problems(subject, grade, unit, count)):
+                yield event
+            return
+
+        if use_cache and problem_list:
+            await self.response_cache.set(prompt, problems_data)
+            if batch_key is not None:
+                self.problem_pool.add(batch_key, problem_list)
+
+    async def _stream_content(self, prompt, is_reading):
+        """Geminiのストリーミング出力を逐次パースし、閉じた要素から順に返す"""
+        generation_config = genai.types.GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=READING_SCHEMA if is_reading else PROBLEM_SCHEMA
+        )
+
+        parsers = []
+        if is_reading:
+            passages = ijson.sendable_list()
+            parsers.append(('passage', passages, ijson.items_coro(passages, 'reading_passage')))
+        problems = ijson.sendable_list()
+        item_prefix = 'questions.item' if is_reading else 'problems.item'
+        parsers.append(('problem', problems, ijson.items_coro(problems, item_prefix, use_float=True)))
+
+        def drain(feed):
+            """パーサーに入力し、完成した要素を取り出す"""
+            ready = []
+            for event, results, parser in parsers:
+                feed(parser)
+                ready.extend((event, item) for item in results)
+                del results[:]
+            return ready
+
+        # 逐次パースに失敗した場合に備えて、受信したテキストを全て保持しておく
+        raw_chunks = []
+        sent = {'passage': 0, 'problem': 0}
+        parse_failed = False
+
+        # 生成はチャンクを受信し終えるまで続くため、その間は同時実行数の枠を保持する
+        async with gemini_semaphore:
+            response = await self._generate_content(prompt, generation_config, stream=True)
+            async for chunk in response:
+                text = chunk.text
+                raw_chunks.append(text)
+                if parse_failed:
+                    continue
+                data = text.encode()
+                try:
+                    ready = drain(lambda parser: parser.send(data))
+                except ijson.JSONError as e:
+                    logger.warning("ストリームの逐次パースに失敗したため、全文受信後に再解析します: %s", e)
+                    parse_failed = True
+                    continue
+                for event, item in ready:
+                    sent[event] += 1
+                    yield event, item
+
+        if not parse_failed:
+            try:
+                ready = drain(lambda parser: parser.close())
+            except ijson.JSONError as e:
+                logger.warning("ストリームの逐次パースに失敗したため、全文受信後に再解析します: %s", e)
+                parse_failed = True
+            else:
+                for event, item in ready:
+                    yield event, item
+                return
+
+        # 不正なエスケープなどを修正して全文を解析し、まだ送っていない要素だけを返す
+        problems_data = self._parse_response_text(''.join(raw_chunks))
+        seen = {'passage': 0, 'problem': 0}
+        for event, item in self._iter_events(problems_data):
+            seen[event] += 1
+            if seen[event] > sent[event]:
+                yield event, item
+
+    def _iter_events(self, problems_data):
+        """生成済みの問題データをストリーミングと同じイベント列に変換"""
+        if 'reading_passage' in problems_data:
+            yield 'passage', problems_data['reading_passage']
+        for problem in problems_data.get('questions', problems_data.get('problems', [])):
+            yield 'problem', problem
+
+    def _batch_key(self, subject, grade, unit, problem_type, difficulty, options):
+        """同じプロンプトで生成できるリクエストを判定するためのキー"""
+        prompt_options = tuple(
+            (name, options[name]) for name in PROMPT_OPTION_KEYS if options.get(name)
+        )
+        return (subject, grade, unit, problem_type, difficulty, prompt_options)
+
+    async def _generate_batch(self, group_key, count):
+        """まとめられたリクエスト分の問題を1回のAI呼び出しで生成"""
+        batch_key, use_cache = group_key
+        if use_cache:
+            # 少なくとも POOL_MIN_SIZE 問生成し、まとめて問題プールに保存して以降のリクエストで使い回す
+            count = min(max(count, POOL_MIN_SIZE), MAX_PROBLEMS_PER_CALL)
+
+        subject, grade, unit, problem_type, difficulty, prompt_options = batch_key
+        prompt = self._build_prompt(subject, grade, unit, problem_type, count, difficulty, dict(prompt_options))
+        problems_data = await self._request_problems(prompt, PROBLEM_SCHEMA)
+        problems = problems_data.get('problems', [])
+        if use_cache and problems:
+            self.problem_pool.add(batch_key, problems)
+        return problems
+
+    def _build_prompt(self, subject, grade, unit, problem_type, count, difficulty, options):
+        """科目・学年に応じたプロンプトを組み立てる"""
         if grade == '高校英語長文':
             paragraph_count = options.get('paragraphCount', '3') if options else '3'
-            prompt = self._build_english_reading_prompt(
+            return self._build_english_reading_prompt(
                 grade=grade,
                 unit=unit,
                 problem_type=problem_type,
@@ -122,32 +649,57 @@ class ProblemGenerator:
                 paragraph_count=paragraph_count
             )
         elif subject == 'math':
-            prompt = self._build_math_prompt(grade, unit, problem_type, count, difficulty, options)
+            return self._build_math_prompt(grade, unit, problem_type, count, difficulty, options)
         else:
-            prompt = self._build_english_prompt(grade, unit, problem_type, count, difficulty, options)
-        
-        generation_config = genai.types.GenerationConfig(
-            response_mime_type="application/json"
-        )
-        
-        try:
-            response = model.generate_content(
+            return self._build_english_prompt(grade, unit, problem_type, count, difficulty, options)
+
+    @retry(
+        wait=wait_exponential(min=1, max=30),
+        stop=stop_after_attempt(3),
+        retry=retry_if_exception_type(ResourceExhausted),
+        reraise=True
+    )
+    async def _generate_content(self, prompt, generation_config, stream=False):
+        """
+        同時実行数を制限してGeminiを呼び出す（クォータ超過時は指数バックオフで再試行）。
+        ストリーミングは最初のチャンクで呼び出しが返るため、呼び出し側が受信完了まで枠を保持する。
+        """
+        if stream:
+            return await model.generate_content_async(
+                prompt,
+                generation_config=generation_config,
+                stream=True
+            )
+        async with gemini_semaphore:
+            return await model.generate_content_async(
                 prompt,
                 generation_config=generation_config
             )
-            
-            raw_text = response.text
+
+    async def _request_problems(self, prompt, response_schema):
+        """Gemini APIを呼び出し、JSONレスポンスを辞書として返す"""
+        generation_config = genai.types.GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=response_schema
+        )
+
+        response = await self._generate_content(prompt, generation_config)
+        return self._parse_response_text(response.text)
+
+    def _parse_response_text(self, raw_text):
+        """AIの出力をJSONとして解析する（失敗した場合はエスケープを修正して再解析）"""
+        try:
+            return orjson.loads(raw_text)
+        except orjson.JSONDecodeError:
+            pass
+
+        # 不正なエスケープを含む場合のみ修正してから再度パースする
+        try:
             fixed_text = self._fix_json_escapes(raw_text)
-            problems_data = json.loads(fixed_text)
-            
-            return problems_data
-        except Exception as e:
-            print(f"AI生成エラー ({type(e).__name__}): {e}")
-            if 'response' in locals() and hasattr(response, 'text'):
-                print("--- 問題が発生したテキスト ---")
-                print(response.text)
-                print("--------------------------")
-            return self._generate_fallback_problems(subject, grade, unit, count)
+            return orjson.loads(fixed_text)
+        except orjson.JSONDecodeError:
+            logger.warning("JSONの解析に失敗しました。問題が発生したテキスト:\n%s", raw_text)
+            raise
 
     def _build_english_reading_prompt(self, grade, unit, problem_type, count, difficulty, paragraph_count=None):
         """高校英語長文問題生成用プロンプト"""
@@ -158,51 +710,14 @@ class ProblemGenerator:
             task_instruction = f"そして、その長文の内容に関する{problem_type}を{count}問作成してください。"
 
         # ▼▼▼ プロンプトの指示を強化 ▼▼▼
-        return f"""
-
-あなたは予備校の英語の講師です。以下の指示に厳密に従って、高品質な英語長文問題を作成してください。
-
-【最重要指示】
-これから生成する英語長文は、必ず、厳密に {paragraph_count} 個の段落で構成してください。これより多くても少なくても絶対に不可です。
-
-【タスク】
-1. トピックが「{unit}」に関連する、高校生レベルの英語長文を1つ、上記の段落数厳守で生成します。
-2. {task_instruction}
-
-難易度は「{difficulty}」でお願いします。
-
-以下の形式でJSONで回答してください：
-{{
-  "reading_passage": "生成した英語長文",
-  "questions": [
-    {{
-      "id": 1,
-      "question": "設問文",
-      "choices": ["選択肢1", "選択肢2", "選択肢3", "選択肢4"],
-      "answer": "正解",
-      "explanation": "詳しい解説"
-    }}
-  ]
-}}
-
-【詳細な要件】
-- 長文は{difficulty}, {grade}のレベルに適した語彙・文法を使用すること。
-- {difficulty}が「基礎」の場合、英検3級から英検準2級レベルの語彙・文法を使用し、英語コミュニケーションの教科書レベルの問題を作成すること。
-- {difficulty}が「標準」の場合、英検準2級から英検2級レベルの語彙・文法を使用し、英語コミュニケーションの教科書レベルの問題を作成すること。
-- {difficulty}が「応用」の場合、英検準2級から英検2級レベルの語彙・文法を使用し、大学入試レベルの問題を作成すること。
-- {difficulty}が「発展」の場合、英検2級から英検準1級以上のレベルの語彙・文法を使用し、大学入試レベルの問題を作成すること。
-- {unit}に関する文章をそのまま書くのではなく、関連する内容を含む長文を必ず生成すること。
-- 問題はその段落について問う問題は避け、長文全体の内容に関する問題を作成すること。
-- 記述問題の場合、必ず12語以内で答えられる問題にすること。
-- 1個の問題の中に2つ以上の要素を含めないこと。
-- 段落ごとの文章量は、平均して100-120語程度とすること。
-- 全て同じようなジャンルの問題にはしないこと。多様なジャンルの問題にすること。
-- `questions`配列には、必ず{count}個の問題オブジェクトを含めること。
-- 設問は長文の内容に関するものにすること。
-- "choices"は選択問題の場合のみ含めること。
-- 解説は「である調」で、簡潔に記述すること。
-- 数式はLaTeX記法 (例: \\( ... \\) や $...$) を一切使わず、プレーンテキストと一般的な記号(+, -, *, /, ^)のみで表現すること。
-"""
+        return READING_PROMPT_TEMPLATE.substitute(
+            paragraph_count=paragraph_count,
+            unit=unit,
+            task_instruction=task_instruction,
+            difficulty=difficulty,
+            grade=grade,
+            count=count
+        )
 
     def _build_math_prompt(self, grade, unit, problem_type, count, difficulty, options):
         """数学問題生成用プロンプト"""
@@ -212,48 +727,13 @@ class ProblemGenerator:
         else:
             instruction = f"{grade}の数学「{unit}」に関する{problem_type}を{count}問作成してください。"
 
-        base_prompt = f"""
-    {instruction}
-
-以下の形式でJSONで回答してください：
-{{
-    "problems": [
-        {{
-            "id": 1,
-            "question": "問題文",
-            "choices": ["選択肢1", "選択肢2", "選択肢3", "選択肢4"],
-            "answer": "正解",
-            "explanation": "詳しい解説"
-        }}
-    ]
-}}
-
-要件：
-- 問題は{grade}のレベルに適した、難易度「{difficulty}」で作成すること
-- {difficulty}が基礎の場合、教科書の例題レベルの問題を作成すること
-- {difficulty}が標準の場合、教科書の練習問題レベルの問題を作成すること
-- {difficulty}が応用の場合、教科書の発展問題レベルの問題を作成すること
-- {difficulty}が発展かつ{grade}が中学1年生、中学2年生、中学3年生の場合、高校入試レベルの問題を作成すること
-- {difficulty}が発展かつ{grade}が数学ⅠA、数学ⅡB、数学ⅢCの場合、大学入試レベルの問題を作成すること
-- 解説は生徒が理解しやすいよう詳しく書く
-- 計算過程も含める
-- "choices"は{problem_type}が「選択問題」の場合のみ含めること。それ以外の場合はnullではなくキー自体を省略すること。
-- 【最重要ルール】JSONの仕様を厳格に遵守すること。JSON文字列内でバックスラッシュ(`\\`)を1つだけ使用することは絶対に禁止。
-- 解答解説は「ですます調」ではなく、簡潔な「である調」で記述すること。
-- 解説は、要点を押さえて、必ず簡潔に記述すること。計算過程は主要なステップのみを示すこと。
-- pi, theta, sigma, alpha, betaなどの英語はそれぞれの記号（π, θ, Σ, α, β）を使用すること。
-- _barはバー（上線）を意味するので、例えば「x_bar」は「x_」と表記すること。
-- sqrtは平方根を意味するので、例えば「sqrt(2)」は「√2」と表記すること。
-- ネイピア数は「e」と表記すること。expの使用は禁止。
-- {unit}が積分法の場合、不定積分と定積分の計算問題のみを出題すること。面積や体積の問題は出題禁止。
-- 三角関数の積分問題を出題する場合は、逆関数や双曲線関数を扱う問題は出題禁止。
-- 数学ⅡBと数学ⅢCの積分法の定積分の表記方法は、必ず「∫[a→b]f(x) dx」の形式で記述すること。
-- 自然対数は必ず「log(x)」と表記すること。
-- 【最重要ルール】下付き文字や上付き文字は、Unicode文字（例: ₂, ²）を使わず、必ずHTMLタグ（例: log<sub>2</sub>(x), x<sup>2</sup>）を使って表現すること。
-- 掛け算を表す記号「⋅」は、必ず <font name="DejaVu">⋅</font> のようにフォントタグで囲んでください。
-- 数式はLaTeX記法 (例: \\( ... \\) や $...$) を一切使わず、プレーンテキストと一般的な記号(+, -, *, /, ^)のみで表現すること。
-- 「*」、「\」は使わないこと
-"""
+        base_prompt = MATH_PROMPT_TEMPLATE.substitute(
+            instruction=instruction,
+            grade=grade,
+            unit=unit,
+            problem_type=problem_type,
+            difficulty=difficulty
+        )
         
         if grade == "数学ⅡB" and unit in ["微分法", "積分法"]:
             base_prompt += "\n- 重要：必ず数学Ⅱの範囲（多項式関数の微分・積分）のみで問題を作成してください。数学Ⅲで扱う関数（三角関数、指数関数、対数関数など）の微分・積分は絶対に含めないでください。"
@@ -270,66 +750,23 @@ class ProblemGenerator:
         """英文法問題生成用プロンプト"""
 
         # 全ての形式で共通する基本的な要件
-        common_requirements = f"""
-- 難易度は「{difficulty}」とすること
-- {difficulty}が「基礎」の場合、教科書の例題レベルの問題を作成すること
-- {difficulty}が「標準」の場合、教科書の練習問題レベルの問題を作成すること
-- {difficulty}が「応用」の場合、教科書の発展問題レベルの問題を作成すること
-- {difficulty}が発展かつ{grade}が中学1年生、中学2年生、中学3年生の場合、高校入試レベルの問題を作成すること
-- {difficulty}が発展かつ{grade}が高校英文法の場合、大学入試レベルの問題を作成すること
-- 解説では文法ポイントも詳しく説明
-- 実用的な例文を使用
-- "choices"は問題形式が「選択問題」の場合のみ含めること。それ以外の形式の場合はキー自体を省略すること。
-- JSON文字列内にバックスラッシュ(`\\`)を含める場合は、必ず二重バックスラッシュ(`\\\\`)としてエスケープすること。
-- 解答解説は「ですます調」ではなく、簡潔な「である調」で記述すること。
-- 数式はLaTeX記法 (例: \\( ... \\) や $...$) を一切使わず、プレーンテキストと一般的な記号(+, -, *, /, ^)のみで表現すること。
-- 「*」は使わないこと
-"""
+        common_requirements = ENGLISH_COMMON_REQUIREMENTS_TEMPLATE.substitute(difficulty=difficulty, grade=grade)
 
         # ユーザーの選択に応じて、タスク指示と追加要件を切り替える
         if problem_type == "おまかせ (ミックス)":
-            task_instruction = f"""{grade}の英語「{unit}」に関する問題を、以下の形式をバランス良く組み合わせて合計{count}問作成してください。
-- 空所補充問題
-- 語句整序問題（並び替え）
-- 間違い探し問題
-- 和文英訳問題"""
+            task_instruction = ENGLISH_MIX_INSTRUCTION_TEMPLATE.substitute(grade=grade, unit=unit, count=count)
             
-            specific_requirements = """
-- 【最重要】必ず「空所補充」「語句整序」「間違い探し」「和文英訳」など、異なる形式の問題を混ぜて出題すること。
-- 語句整序問題の場合、questionには並び替えるべき語句を()で示し、answerには正しい全文を記述すること。例: question: "次の語句を並び替えて文を完成させなさい。 (me / to / he / a letter / sent).", answer: "He sent me a letter."
-- 間違い探し問題の場合、questionには誤りを含む文を提示し、answerには修正後の正しい語句または文を記述すること。
-"""
+            specific_requirements = ENGLISH_MIX_REQUIREMENTS
             requirements = common_requirements + specific_requirements
 
         else:  # 「選択問題」「穴埋め問題」「記述問題」などが選択された場合
             task_instruction = f"{grade}の英語「{unit}」に関する{problem_type}を{count}問作成してください。"
             
-            specific_requirements = f"""
-- 【最重要】必ず全ての問題を「{problem_type}」の形式で作成すること。他の形式の問題は絶対に混ぜないこと。
-- 正解は文法的に一意に定まるものであり、他の選択肢は明確に不正解となるように作成すること。
-"""
+            specific_requirements = ENGLISH_SINGLE_REQUIREMENTS_TEMPLATE.substitute(problem_type=problem_type)
             requirements = common_requirements + specific_requirements
 
         # 最終的なプロンプトを組み立てる
-        base_prompt = f"""
-{task_instruction}
-
-以下の形式でJSONで回答してください：
-{{
-    "problems": [
-        {{
-            "id": 1,
-            "question": "問題文",
-            "choices": ["選択肢1", "選択肢2", "選択肢3", "選択肢4"],
-            "answer": "正解",
-            "explanation": "詳しい解説（文法ポイントも含む）"
-        }}
-    ]
-}}
-
-要件：
-{requirements}
-"""
+        base_prompt = ENGLISH_PROMPT_TEMPLATE.substitute(task_instruction=task_instruction, requirements=requirements)
         
         if options and options.get('vocabulary_list'):
             base_prompt += f"\n- 以下の単語を含める: {options['vocabulary_list']}"
@@ -358,130 +795,84 @@ class ProblemGenerator:
         
         return {"problems": problems}
 
+    @functools.lru_cache(maxsize=64)
     def get_units_for_grade(self, subject, grade):
         """学年に応じた単元リストを取得"""
-        return self.subject_templates.get(subject, {}).get('units', {}).get(grade, [])
-
-class PDFGenerator:
-    def __init__(self):
-        self.styles = getSampleStyleSheet()
-        self.setup_styles()
-
-    def setup_styles(self):
-        self.title_style = ParagraphStyle(
-            'CustomTitle', parent=self.styles['Heading1'], fontName=FONT_NAME,
-            fontSize=16, spaceAfter=20, alignment=1
-        )
-        self.question_style = ParagraphStyle(
-            'Question', parent=self.styles['Normal'], fontName=FONT_NAME,
-            fontSize=12, spaceAfter=10, leftIndent=10
-        )
-        self.answer_style = ParagraphStyle(
-            'Answer', parent=self.styles['Normal'], fontName=FONT_NAME,
-            fontSize=11, spaceAfter=15, leftIndent=20, textColor=colors.blue
-        )
-        self.passage_style = ParagraphStyle(
-            'Passage', parent=self.styles['Normal'], fontName=FONT_NAME,
-            fontSize=12, spaceAfter=15, leftIndent=10, leading=16
-        )
-
-        self.explanation_style = ParagraphStyle(
-            'Explanation',
-            parent=self.styles['Normal'],
-            fontName=FONT_NAME,
-            fontSize=11,          # 解説文のフォントサイズを少し小さく
-            leftIndent=20,        # 解答とインデントを合わせる
-            leading=20            # 行間を広げる
-        )
-
-    def generate_pdf(self, problems_data, subject, grade, unit):
-        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-        temp_filename = temp_file.name
-        temp_file.close()
-        
-        doc = SimpleDocTemplate(temp_filename, pagesize=A4,
-                              rightMargin=20*mm, leftMargin=20*mm,
-                              topMargin=20*mm, bottomMargin=20*mm)
-        story = []
-        title = f"{subject.upper()} - {grade} - {unit}"
-        story.append(Paragraph(title, self.title_style))
-        story.append(Spacer(1, 20))
-        
-        if 'reading_passage' in problems_data:
-            story.append(Paragraph("【長文】", self.title_style))
-            passage_text = problems_data['reading_passage'].replace('\n', '<br/>')
-            story.append(Paragraph(passage_text, self.passage_style))
-            story.append(PageBreak())
-            
-            story.append(Paragraph("【問題】", self.title_style))
-            question_list = problems_data.get('questions', [])
-            
-            for problem in question_list:
-                question_text = f"問{problem['id']}. {problem['question']}".replace('<br>', '<br/>')
-                story.append(Paragraph(question_text, self.question_style))
-                if 'choices' in problem and problem['choices']:
-                    for i, choice in enumerate(problem['choices']):
-                        choice_text = f"({chr(65+i)}) {choice}".replace('<br>', '<br/>')
-                        story.append(Paragraph(choice_text, self.question_style))
-                story.append(Spacer(1, 15))
-            
-            story.append(PageBreak())
-            story.append(Paragraph("【解答・解説】", self.title_style))
-            
-            for problem in question_list:
-                answer_text = f"問{problem['id']}. 解答: {problem['answer']}"
-                story.append(Paragraph(answer_text, self.answer_style))
-                explanation_text = f"解説: {problem.get('explanation', '解説はありません。')}".replace('<br>', '<br/>')
-                story.append(Paragraph(explanation_text, self.explanation_style)) # スタイルを変更
-                story.append(Spacer(1, 20))
-        
-        else:
-            story.append(Paragraph("【問題】", self.title_style))
-            problem_list = problems_data.get('problems', [])
-
-            for problem in problem_list:
-                question_text = f"問{problem['id']}. {problem['question']}"
-                story.append(Paragraph(question_text, self.question_style))
-                if 'choices' in problem and problem['choices']:
-                    for i, choice in enumerate(problem['choices']):
-                        choice_text = f"({chr(65+i)}) {choice}".replace('<br>', '<br/>')
-                        story.append(Paragraph(choice_text, self.question_style))
-                story.append(Spacer(1, 15))
-            
-            story.append(PageBreak())
-            story.append(Paragraph("【解答・解説】", self.title_style))
-            
-            for problem in problem_list:
-                answer_text = f"問{problem['id']}. 解答: {problem['answer']}"
-                story.append(Paragraph(answer_text, self.answer_style))
-                explanation_text = f"解説: {problem.get('explanation', '解説はありません。')}".replace('<br>', '<br/>')
-                story.append(Paragraph(explanation_text, self.explanation_style)) # スタイルを変更
-                story.append(Spacer(1, 20))
-        
-        doc.build(story)
-        return temp_filename
+        return SUBJECT_UNITS.get(subject, EMPTY_UNITS).get(grade, ())
 
 problem_generator = ProblemGenerator()
-pdf_generator = PDFGenerator()
+
+# PDF生成はCPUを占有するため、イベントループを止めないよう別プロセスで実行する
+# （プールはサーバー起動時にワーカーごとに作成し、子プロセスは pdf_builder のみを読み込む）
+pdf_pool = None
+
+@app.before_serving
+async def start_background_workers():
+    global pdf_pool
+    problem_generator.batch_processor.start()
+    # Gemini の gRPC 接続を持つプロセスを fork しないよう spawn で子プロセスを起動する
+    pdf_pool = ProcessPoolExecutor(
+        max_workers=PDF_POOL_WORKERS,
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+@app.after_serving
+async def stop_background_workers():
+    await problem_generator.batch_processor.stop()
+    if pdf_pool is not None:
+        pdf_pool.shutdown(wait=False, cancel_futures=True)
 
 @app.route('/')
-def index():
-    return render_template('index.html')
+async def index():
+    return await render_template('index.html')
 
 @app.route('/api/get_units')
-def get_units():
+async def get_units():
     subject = request.args.get('subject')
     grade = request.args.get('grade')
     if not subject or not grade:
         return jsonify({'error': 'Subject and grade are required'}), 400
     units = problem_generator.get_units_for_grade(subject, grade)
-    return jsonify({'units': units})
+
+    # 単元一覧はデプロイ中に変わらないため、ブラウザにキャッシュさせる
+    # （If-None-Match は弱い比較で照合し、プロキシが W/ を付けたETagでも304を返す）
+    etag = hashlib.md5(orjson.dumps([subject, grade, units])).hexdigest()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({'units': units})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = UNITS_CACHE_CONTROL
+    return response
+
+def validate_problem_request(data):
+    """問題生成リクエストの入力を検証し、不正な場合はエラーメッセージを返す"""
+    if not isinstance(data, dict):
+        return 'Request body must be a JSON object'
+    for field in ('subject', 'grade', 'unit', 'problemType'):
+        if not isinstance(data.get(field), str) or not data.get(field):
+            return f'{field} must be a non-empty string'
+    if not isinstance(data.get('difficulty', '標準'), str):
+        return 'difficulty must be a string'
+    for name in PROMPT_OPTION_KEYS:
+        if not isinstance(data.get(name), (str, bool, int, float, type(None))):
+            return f'{name} must be a scalar value'
+    try:
+        count = int(data.get('count', 3))
+    except (TypeError, ValueError):
+        return 'count must be an integer'
+    if not 1 <= count <= MAX_PROBLEMS_PER_CALL:
+        return f'count must be between 1 and {MAX_PROBLEMS_PER_CALL}'
+    return None
 
 @app.route('/api/generate_problems', methods=['POST'])
-def generate_problems():
-    data = request.get_json()
+async def generate_problems():
+    data = await request.get_json()
+    error = validate_problem_request(data)
+    if error:
+        return jsonify({'error': error}), 400
     try:
-        problems = problem_generator.generate_problems(
+        problems = await problem_generator.generate_problems(
             subject=data.get('subject'),
             grade=data.get('grade'),
             unit=data.get('unit'),
@@ -492,25 +883,67 @@ def generate_problems():
         )
         return jsonify(problems)
     except Exception as e:
-        print(f"APIルートエラー: {e}")
+        logger.exception("APIルートエラー: %s", e)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/generate_problems_stream', methods=['POST'])
+async def generate_problems_stream():
+    """生成された問題を Server-Sent Events で1問ずつ返す"""
+    data = await request.get_json()
+    error = validate_problem_request(data)
+    if error:
+        return jsonify({'error': error}), 400
+    stream = problem_generator.stream_problems(
+        subject=data.get('subject'),
+        grade=data.get('grade'),
+        unit=data.get('unit'),
+        problem_type=data.get('problemType'),
+        count=int(data.get('count', 3)),
+        difficulty=data.get('difficulty', '標準'),
+        options=data
+    )
+
+    async def sse_events():
+        try:
+            async for event, payload in stream:
+                yield f"event: {event}\ndata: {orjson.dumps(payload).decode()}\n\n".encode()
+        except Exception as e:
+            logger.exception("ストリーミング生成エラー: %s", e)
+            yield f"event: error\ndata: {orjson.dumps({'error': str(e)}).decode()}\n\n".encode()
+        yield b"event: done\ndata: {}\n\n"
+
+    response = Response(sse_events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # AIの生成が終わるまで接続を保持するため、レスポンスのタイムアウトを無効化する
+    response.timeout = None
+    return response
+
 @app.route('/api/generate_pdf', methods=['POST'])
-def generate_pdf():
-    data = request.get_json()
+async def generate_pdf():
+    data = await request.get_json()
     try:
-        pdf_path = pdf_generator.generate_pdf(
-            problems_data=data.get('problems'),
-            subject=data.get('subject'),
-            grade=data.get('grade'),
-            unit=data.get('unit')
+        pdf_bytes = await asyncio.get_running_loop().run_in_executor(
+            pdf_pool,
+            generate_pdf_bytes,
+            data.get('problems'),
+            data.get('subject'),
+            data.get('grade'),
+            data.get('unit')
         )
+        pdf_buffer = io.BytesIO(pdf_bytes)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"{data.get('subject')}_{data.get('grade')}_{data.get('unit')}_{timestamp}.pdf"
-        return send_file(pdf_path, as_attachment=True, download_name=filename, mimetype='application/pdf')
-    except Exception as e:
-        print(f"PDF生成ルートエラー: {e}")
-        return jsonify({'error': str(e)}), 500
 
-if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+        async def stream_pdf():
+            while chunk := pdf_buffer.read(PDF_CHUNK_SIZE):
+                yield chunk
+
+        response = Response(stream_pdf(), mimetype='application/pdf')
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+        response.headers['Content-Length'] = str(len(pdf_bytes))
+        # 生成のたびに内容が変わるため、キャッシュさせない（send_file の max_age=0 相当）
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logger.exception("PDF生成ルートエラー: %s", e)
+        return jsonify({'error': str(e)}), 500
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+PDF生成処理（ReportLabのみに依存する）。
+PDF生成用の子プロセスはこのモジュールだけを読み込むため、Gemini の設定やキャッシュを持たない。
+"""
+import functools
+import io
+import logging
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+
+logger = logging.getLogger('quiz')
+
+#フォントの設定
+@functools.cache
+def get_font_name():
+    """フォントを登録して使用するフォント名を返す（最初のPDF生成時に一度だけ読み込む）"""
+    try:
+        pdfmetrics.registerFont(TTFont('NotoSansCJK', 'NotoSansJP-Regular.ttf'))
+        pdfmetrics.registerFont(TTFont('DejaVu', 'DejaVuSans.ttf'))
+        return 'NotoSansCJK'
+
+    except Exception as e:
+        logger.warning("フォント読み込みエラー: %s", e)
+        logger.warning("日本語フォントが読み込めないため、英語フォント(Helvetica)にフォールバックします。文字化けする可能性があります。")
+        return 'Helvetica'
+
+# PDFのスタイル（全リクエストで共有する）
+SAMPLE_STYLES = getSampleStyleSheet()
+
+@functools.cache
+def get_pdf_styles():
+    """PDF用の段落スタイルを生成する（フォント登録後に一度だけ作成）"""
+    font_name = get_font_name()
+    return {
+        'title': ParagraphStyle(
+            'CustomTitle', parent=SAMPLE_STYLES['Heading1'], fontName=font_name,
+            fontSize=16, spaceAfter=20, alignment=1
+        ),
+        'question': ParagraphStyle(
+            'Question', parent=SAMPLE_STYLES['Normal'], fontName=font_name,
+            fontSize=12, spaceAfter=10, leftIndent=10
+        ),
+        'answer': ParagraphStyle(
+            'Answer', parent=SAMPLE_STYLES['Normal'], fontName=font_name,
+            fontSize=11, spaceAfter=15, leftIndent=20, textColor=colors.blue
+        ),
+        'passage': ParagraphStyle(
+            'Passage', parent=SAMPLE_STYLES['Normal'], fontName=font_name,
+            fontSize=12, spaceAfter=15, leftIndent=10, leading=16
+        ),
+        'explanation': ParagraphStyle(
+            'Explanation',
+            parent=SAMPLE_STYLES['Normal'],
+            fontName=font_name,
+            fontSize=11,          # 解説文のフォントサイズを少し小さく
+            leftIndent=20,        # 解答とインデントを合わせる
+            leading=20            # 行間を広げる
+        ),
+    }
+
+class PDFGenerator:
+    def generate_pdf_bytes(self, problems_data, subject, grade, unit):
+        """PDFを生成してバイト列で返す（別プロセスで実行できるよう戻り値はbytes）"""
+        styles = get_pdf_styles()
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(buffer, pagesize=A4,
+                              rightMargin=20*mm, leftMargin=20*mm,
+                              topMargin=20*mm, bottomMargin=20*mm)
+        story = []
+        title = f"{subject.upper()} - {grade} - {unit}"
+        story.append(Paragraph(title, styles['title']))
+        story.append(Spacer(1, 20))
+        
+        if 'reading_passage' in problems_data:
+            story.append(Paragraph("【長文】", styles['title']))
+            passage_text = problems_data['reading_passage'].replace('\n', '<br/>')
+            story.extend([Paragraph(passage_text, styles['passage']), PageBreak()])
+            question_list = problems_data.get('questions', [])
+        else:
+            question_list = problems_data.get('problems', [])
+
+        self._render_questions(story, question_list, styles)
+        
+        doc.build(story)
+        return buffer.getvalue()
+
+    def _render_questions(self, story, question_list, styles):
+        """【問題】と【解答・解説】のページを story に追加"""
+        question_style = styles['question']
+        answer_style = styles['answer']
+        explanation_style = styles['explanation']
+
+        # 問題と解答・解説を1回の走査でまとめて組み立てる
+        question_flow, answer_flow = [], []
+        for problem in question_list:
+            problem_id = problem['id']
+            question_flow.append(Paragraph(f"問{problem_id}. {problem['question']}".replace('<br>', '<br/>'), question_style))
+            choices = problem.get('choices')
+            if choices:
+                question_flow.extend(
+                    Paragraph(f"({chr(65+i)}) {choice}".replace('<br>', '<br/>'), question_style)
+                    for i, choice in enumerate(choices)
+                )
+            question_flow.append(Spacer(1, 15))
+
+            explanation = problem.get('explanation', '解説はありません。')
+            answer_flow.extend([
+                Paragraph(f"問{problem_id}. 解答: {problem['answer']}", answer_style),
+                Paragraph(f"解説: {explanation}".replace('<br>', '<br/>'), explanation_style),
+                Spacer(1, 20),
+            ])
+
+        story.append(Paragraph("【問題】", styles['title']))
+        story.extend(question_flow)
+        story.extend([PageBreak(), Paragraph("【解答・解説】", styles['title'])])
+        story.extend(answer_flow)
+
+pdf_generator = PDFGenerator()
+
+def generate_pdf_bytes(problems_data, subject, grade, unit):
+    """プロセスプールから呼び出すためのモジュールレベル関数"""
+    return pdf_generator.generate_pdf_bytes(problems_data, subject, grade, unit)
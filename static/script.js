@@ -250,7 +250,12 @@ function getFieldDisplayName(field) {
 }
 
 // 問題生成
+// 長文はまとめて生成できず時間もかかるため、本文から順に表示するストリーミングを使う
+// それ以外は同じ条件のリクエストをまとめて生成・再利用できる通常のAPIを使う
 async function generateProblems(data) {
+    if (data.grade === '高校英語長文') {
+        return generateProblemsStream(data);
+    }
     try {
         showLoading(true);
         hidePreview();
@@ -280,6 +285,89 @@ async function generateProblems(data) {
     }
 }
 
+// 問題生成（生成された問題から順に表示する）
+async function generateProblemsStream(data) {
+    try {
+        showLoading(true);
+        hidePreview();
+        
+        const response = await fetch('/api/generate_problems_stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(data)
+        });
+        
+        if (!response.ok) {
+            const error = await response.json();
+            throw new Error(error.error || '問題生成に失敗しました');
+        }
+
+        const result = {};
+        const problems = [];
+        await readEventStream(response, (event, payload) => {
+            if (event === 'passage') {
+                result.reading_passage = payload;
+                result.questions = problems;
+            } else if (event === 'problem') {
+                problems.push(payload);
+                if (!result.questions) {
+                    result.problems = problems;
+                }
+            } else if (event === 'error') {
+                throw new Error(payload.error || '問題生成に失敗しました');
+            } else {
+                return;
+            }
+            displayProblems(result);
+            if (elements.previewSection.style.display !== 'block') {
+                showPreview();
+            }
+        });
+
+        if (problems.length === 0) {
+            throw new Error('問題生成に失敗しました');
+        }
+        appState.setProblems(result);
+    } catch (error) {
+        console.error('問題生成エラー:', error);
+        showError('問題の生成に失敗しました: ' + error.message);
+    } finally {
+        showLoading(false);
+    }
+}
+
+// Server-Sent Events 形式のレスポンスを読み込み、イベントごとにコールバックを呼ぶ
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let dataText = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) {
+                    event = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    dataText += line.slice(6);
+                }
+            });
+            onEvent(event, JSON.parse(dataText));
+        }
+    }
+}
+
 // ローディング表示制御
 function showLoading(show) {
     appState.setLoading(show);